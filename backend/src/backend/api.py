@@ -1,63 +1,85 @@
-from fastapi import FastAPI, Response
+from contextlib import aclosing
+import secrets
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.responses import StreamingResponse, JSONResponse
-from fastapi.exceptions import HTTPException
-import cv2
-import time
+from fastapi.exceptions import HTTPException, WebSocketException
+from starlette.types import Send
 
-from backend.managers.camera_manager import CameraManger, CameraNotFoundError
+from backend.encoding import log_jpeg_backend
+from backend.managers.camera_manager import Camera, CameraManger, CameraNotFoundError, Resolution
+from backend.managers.camera_worker import MAX_FRAME_HEIGHT, MAX_FRAME_WIDTH
 
 # Create api
 app = FastAPI()
 
+# Log which JPEG encoder is being used (warning if it's a slow one)
+log_jpeg_backend()
+
 # Create camera manager
 camera_manager = CameraManger()
 
+# Multipart framing sent before and after each JPEG frame
+FRAME_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+FRAME_TRAILER = b'\r\n'
+
+# Random token that's different every time the api starts, so ETags from before a restart never match
+# (the camera state version starts over on every start)
+ETAG_TOKEN = secrets.token_hex(8)
+
+# The last available cameras response, along with the ETag of the camera state it was made for
+available_cameras_cache: tuple[str, bytes] | None = None
 
-def fps_to_ms(fps: int) -> float:
+
+def camera_state_etag() -> str:
     """
-    Convert frames per second to frames per miliseconds (time between each frame)
+    Return an ETag for the current state of the cameras, which changes whenever any camera is
+    added, removed, started, stopped or has its settings changed
     """
-    return (1/fps) * 1000
+    return f'W/"{ETAG_TOKEN}-{camera_manager.state_version}"'
 
 
-def generate_frames(cap: cv2.VideoCapture, camera_name: str):
+def is_not_modified(request: Request, etag: str) -> bool:
+    """
+    Return True if the client already has the response for the given ETag
     """
-    A generator that will yield the frames for a given camera
+    return request.headers.get('if-none-match') == etag
+
 
-    TODO: Instead of reading frames and yielding them directly, utilize multiprocessing
-     so that each camera is running on its own process and then this loop is only grabbing from said processes queue.
+class FrameStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that sends memoryviews as they are. StreamingResponse only passes through bytes,
+    which would mean copying every frame out of shared memory first.
     """
-    # Capture video frames at specified frame rate
-    time_since_last_frame = 0
-    while camera_manager.camera_is_running(camera_name):
-        # Get the wait time based on fps
-        wait_time = fps_to_ms(camera_manager.get_camera_fps(camera_name))
 
-        # Capture a video frame
-        success, frame = cap.read()
-        if not success:
-            break
+    async def stream_response(self, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        async for chunk in self.body_iterator:
+            if not isinstance(chunk, (bytes, bytearray, memoryview)):
+                chunk = chunk.encode(self.charset)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
 
-        # Check if it's time to send a frame
-        # NOTE: The time function is in millis, so x1000 makes it in seconds
-        if time.time() * 1000 - time_since_last_frame > wait_time:
-            # Get the encoding quality of camera
-            encoding_params = camera_manager.get_camera_encoding_params(
-                camera_name)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
 
-            # Encode frame and convert to byte string
-            ret, buffer = cv2.imencode('.jpg', frame, encoding_params)
-            frame = buffer.tobytes()
 
-            # Yield the current frame
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-            time_since_last_frame = time.time() * 1000
-    cap.release()
+async def generate_frames(camera: Camera):
+    """
+    A generator that will yield the frames for a given camera as a multipart stream
+    """
+    async for frame in camera.stream_async():
+        # Yield the current frame, without concatenating the framing onto it (avoids copying the frame)
+        yield FRAME_HEADER
+        yield frame
+        yield FRAME_TRAILER
 
 
 @app.get("/stream/start/{camera_name}")
-async def start_stream(camera_name: str) -> StreamingResponse:
+async def start_stream(camera_name: str) -> FrameStreamingResponse:
     """
     Take in a camera name and start a video stream
     """
@@ -66,15 +88,45 @@ async def start_stream(camera_name: str) -> StreamingResponse:
         raise HTTPException(
             status_code=400, detail=f"{camera_name} is already streaming")
     try:
-        # Create video capture object for camera
-        cap = camera_manager.start_video_capture(camera_name)
-        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Set camera parameters.
+        # Start capturing frames from the camera
+        camera = camera_manager.start_video_capture(camera_name)
 
     except CameraNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
     # Return streaming response
-    return (StreamingResponse(generate_frames(
-        cap, camera_name), media_type="multipart/x-mixed-replace; boundary=frame"))
+    return (FrameStreamingResponse(generate_frames(
+        camera), media_type="multipart/x-mixed-replace; boundary=frame"))
+
+
+@app.websocket("/stream/ws/{camera_name}")
+async def stream_websocket(websocket: WebSocket, camera_name: str):
+    """
+    Take in a camera name and stream its frames over a WebSocket, sending each JPEG frame as one binary message.
+    Unlike `/stream/start`, there are no multipart headers per frame and one connection can be kept open.
+    """
+    # If camera is already streaming or can't be found, refuse the connection
+    try:
+        if camera_manager.camera_is_running(camera_name):
+            raise WebSocketException(
+                code=status.WS_1008_POLICY_VIOLATION, reason=f"{camera_name} is already streaming")
+
+        # Start capturing frames from the camera
+        camera = camera_manager.start_video_capture(camera_name)
+
+    except CameraNotFoundError as e:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=str(e))
+
+    await websocket.accept()
+    try:
+        # Make sure the camera is stopped as soon as the client disconnects
+        async with aclosing(camera.stream_async()) as frames:
+            async for frame in frames:
+                await websocket.send_bytes(frame)
+    except WebSocketDisconnect:
+        return
+
+    # The stream was ended
+    await websocket.close()
 
 
 @app.post("/stream/end/{camera_name}")
@@ -91,12 +143,24 @@ async def end_stream(camera_name: str) -> Response:
 
 
 @app.get('/stream/available_cameras')
-async def get_available_cameras() -> JSONResponse:
+async def get_available_cameras(request: Request) -> Response:
     """
     Get list of cameras that aren't currently streaming
+
+    Responds with 304 Not Modified if the client's ETag (If-None-Match) is still current,
+    and only rebuilds the list when the cameras have changed.
     """
-    available_cameras = camera_manager.get_available_cameras()
-    return JSONResponse(status_code=200, content=available_cameras)
+    global available_cameras_cache
+
+    etag = camera_state_etag()
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    if available_cameras_cache is None or available_cameras_cache[0] != etag:
+        available_cameras = camera_manager.get_available_cameras()
+        available_cameras_cache = (etag, JSONResponse(content=available_cameras).body)
+    return Response(status_code=200, content=available_cameras_cache[1], media_type='application/json',
+                    headers={'ETag': etag})
 
 
 @app.post('/stream/fps/{camera_name}')
@@ -122,3 +186,47 @@ async def set_camera_encoding_quality(camera_name: str, encoding_quality: int) -
     except CameraNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
     return Response(status_code=200)
+
+
+@app.get('/stream/output_resolution/{camera_name}')
+async def get_camera_output_resolution(camera_name: str, request: Request) -> Response:
+    """
+    Get the resolution (e.g. "1280x720") frames are sent at given a camera name, null if it's the camera's resolution
+
+    Responds with 304 Not Modified if the client's ETag (If-None-Match) is still current.
+    """
+    etag = camera_state_etag()
+    try:
+        resolution = camera_manager.get_camera_stream_resolution(camera_name)
+    except CameraNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    content = str(resolution) if resolution is not None else None
+    return JSONResponse(status_code=200, content=content, headers={'ETag': etag})
+
+
+@app.post('/stream/output_resolution/{camera_name}')
+async def set_camera_output_resolution(camera_name: str, horizontal: int | None = None,
+                                       vertical: int | None = None) -> Response:
+    """
+    Change the resolution frames are sent at given a camera name (up to 1920x1080).
+    Frames are sent at the camera's resolution if no resolution is given.
+    """
+    resolution = None
+    if horizontal is not None or vertical is not None:
+        if horizontal is None or vertical is None or horizontal <= 0 or vertical <= 0:
+            raise HTTPException(
+                status_code=400, detail="horizontal and vertical must both be positive")
+        # Larger frames don't fit in the worker's shared memory slots
+        if horizontal > MAX_FRAME_WIDTH or vertical > MAX_FRAME_HEIGHT:
+            raise HTTPException(
+                status_code=400, detail=f"resolution can't be larger than {MAX_FRAME_WIDTH}x{MAX_FRAME_HEIGHT}")
+        resolution = Resolution(horizontal, vertical)
+
+    try:
+        camera_manager.set_camera_stream_resolution(camera_name, resolution)
+    except CameraNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(status_code=200)
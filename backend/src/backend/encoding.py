@@ -0,0 +1,144 @@
+import logging
+import os
+import platform
+import cv2
+import numpy as np
+
+# Log through uvicorn's logger since it's the one that has a handler when the api is running
+logger = logging.getLogger('uvicorn.error')
+
+# Use libjpeg-turbo directly when it's installed since it skips OpenCV's extra colorspace
+# conversion and always uses the SIMD kernels. OpenCV's encoder is the fallback.
+try:
+    import turbojpeg
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_422
+    _tj = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    _tj = None
+
+
+def _turbojpeg_simd() -> str:
+    """
+    Return the SIMD kernels libjpeg-turbo will pick for this CPU (it chooses them at runtime)
+    """
+    if os.environ.get('JSIMD_FORCENONE') == '1':
+        return 'NO (disabled by JSIMD_FORCENONE)'
+
+    machine = platform.machine().lower()
+    if machine in ('x86_64', 'amd64'):
+        try:
+            with open('/proc/cpuinfo') as cpuinfo:
+                has_avx2 = ' avx2' in cpuinfo.read()
+        except OSError:
+            return 'YES'
+        return 'AVX2' if has_avx2 else 'SSE2'
+    if machine in ('aarch64', 'arm64') or machine.startswith('arm'):
+        return 'NEON'
+    return 'unknown'
+
+
+def log_jpeg_backend():
+    """
+    Log which JPEG encoder frames will be encoded with, warning if it's one without SIMD support
+    (which can be several times slower)
+    """
+    if _tj is not None:
+        logger.info("JPEG backend: libjpeg-turbo (PyTurboJPEG %s), SIMD=%s",
+                    getattr(turbojpeg, '__version__', 'unknown'), _turbojpeg_simd())
+        return
+
+    # OpenCV lists the JPEG library it was built with and whether its SIMD kernels were enabled
+    jpeg_library = 'unknown'
+    simd = 'unknown'
+    in_jpeg_section = False
+    for line in cv2.getBuildInformation().splitlines():
+        key, _, value = line.strip().partition(':')
+        if key == 'JPEG':
+            jpeg_library = value.strip()
+            in_jpeg_section = True
+        elif in_jpeg_section and key == 'SIMD Support':
+            simd = value.strip()
+            break
+
+    logger.info("JPEG backend: OpenCV %s, SIMD=%s", jpeg_library, simd)
+    if simd == 'unknown':
+        logger.warning("Couldn't tell if OpenCV's JPEG encoder was built with SIMD support, so encoding frames may "
+                       "be slow. Install libjpeg-turbo and PyTurboJPEG (pip install backend[turbojpeg]) to use its "
+                       "SIMD encoder.")
+    elif simd != 'YES':
+        logger.warning("OpenCV's JPEG encoder was built without SIMD support, so encoding frames will be slow. "
+                       "Install libjpeg-turbo and PyTurboJPEG (pip install backend[turbojpeg]) to use its SIMD encoder.")
+
+
+def max_jpeg_size(width: int, height: int) -> int:
+    """
+    Return the largest a JPEG of a frame with the given size can be, so TurboJPEG can encode it in place.
+    Matches libjpeg-turbo's tjBufSize() for 4:2:2 subsampling (TurboJPEG's default),
+    which pads the frame to whole 16x8 blocks and allows 4 bytes per pixel plus 2048 bytes of headers.
+    """
+    padded_width = (width + 15) // 16 * 16
+    padded_height = (height + 7) // 8 * 8
+    return padded_width * padded_height * 4 + 2048
+
+
+def encode_jpeg_into(frame: cv2.Mat, encoding_params: list[int], dst: memoryview) -> int | None:
+    """
+    Encode a BGR frame as a JPEG directly into `dst`, given OpenCV encoding parameters
+    in the form [cv2.IMWRITE_JPEG_QUALITY, quality of image (0-100)]
+
+    Returns the size of the JPEG or None if it doesn't fit in `dst`
+    """
+    if _tj is not None:
+        quality = _turbojpeg_quality(encoding_params[1])
+
+        # TurboJPEG can only encode in place if `dst` fits the largest JPEG the frame could possibly be
+        if _tj.buffer_size(frame) <= len(dst):
+            _, size = _tj.encode(frame, quality=quality, pixel_format=TJPF_BGR, dst=dst)
+            return size
+        jpeg = _tj.encode(frame, quality=quality, pixel_format=TJPF_BGR)
+    else:
+        ret, buffer = cv2.imencode('.jpg', frame, encoding_params)
+        jpeg = buffer.reshape(-1)
+
+    return _copy_jpeg_into(jpeg, dst)
+
+
+def can_encode_yuyv() -> bool:
+    """
+    Return True if YUYV frames can be encoded without converting them to BGR first (needs TurboJPEG)
+    """
+    return _tj is not None
+
+
+def encode_yuyv_into(frame: cv2.Mat, width: int, height: int, quality: int, dst: memoryview) -> int | None:
+    """
+    Encode a raw YUYV (packed 4:2:2) frame from the camera as a JPEG into `dst`, given its size and quality (0-100).
+    Only works if `can_encode_yuyv()` is True.
+
+    Returns the size of the JPEG or None if the frame is incomplete or the JPEG doesn't fit in `dst`
+    """
+    if frame.size < width * height * 2:
+        return None
+    yuyv = frame.reshape(-1)[:width * height * 2].reshape(height, width * 2)
+
+    # Each pair of pixels is packed as Y0 U Y1 V, split them into the separate Y, U and V planes TurboJPEG expects
+    planes = np.concatenate((yuyv[:, 0::2], yuyv[:, 1::4], yuyv[:, 3::4]), axis=None)
+    jpeg = _tj.encode_from_yuv(planes, height, width, quality=_turbojpeg_quality(quality), jpeg_subsample=TJSAMP_422)
+    return _copy_jpeg_into(jpeg, dst)
+
+
+def _turbojpeg_quality(quality: int) -> int:
+    """
+    Clamp a quality to the 1-100 TurboJPEG accepts (it raises on anything else, unlike OpenCV which clamps it)
+    """
+    return min(max(quality, 1), 100)
+
+
+def _copy_jpeg_into(jpeg, dst: memoryview) -> int | None:
+    """
+    Copy an encoded JPEG into `dst`, returning its size or None if it doesn't fit
+    """
+    if len(jpeg) > len(dst):
+        return None
+    dst[:len(jpeg)] = jpeg
+    return len(jpeg)
@@ -1,60 +1,81 @@
-import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Callable, NamedTuple
+import asyncio
+import itertools
+import threading
 import cv2
 
+from backend.managers.camera_worker import CameraWorker, FRAME_SLOTS, MAX_JPEG_SIZE, mp_context
 
-def get_camera_name_and_paths() -> dict[str: str]:
+# inotify is optional, without it cameras that are plugged in or unplugged after startup aren't noticed
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Where Video4Linux lists its devices in sysfs, and where their device files are created
+VIDEO4LINUX_PATH = Path("/sys/class/video4linux")
+DEVICE_PATH = Path("/dev")
+
+# Threads that wait for frames from camera workers, so the event loop isn't blocked while waiting
+frame_wait_pool = ThreadPoolExecutor(thread_name_prefix='camera-frames')
+
+
+def fps_to_ns(fps: int) -> int:
     """
-    Returns a dictionary containing the camera name and its path (`/dev/videox`, etc.)
+    Convert frames per second to nanoseconds between each frame (treating anything below 1 fps as 1 fps)
+    """
+    return 1_000_000_000 // max(1, fps)
 
-    This only works on linux systems that have `v412-ctl` installed.
 
-    TODO: Replace with a Video4Linux library rather than directly parsing text
+def get_camera_name_and_paths() -> dict[str: str]:
     """
+    Returns a dictionary containing the camera name and its path (`/dev/videox`, etc.)
 
-    # Try to read available camera streams
-    # If no cameras are found, an error is raised which we ignore
-    command = "v4l2-ctl --list-devices"
-    output = ""
-    try:
-        output = subprocess.check_output(
-            command, shell=True, text=True)
-    except Exception as e:
-        print(f"{e}")
+    This only works on linux systems, since it reads the devices Video4Linux lists in sysfs.
+    """
+    # A camera can have several device files (one for video, one for metadata, etc.)
+    # so devices are sorted by number and only the first one of each camera is kept
+    devices = sorted(VIDEO4LINUX_PATH.glob("video*"), key=lambda device: int(device.name.removeprefix("video")))
 
     # Create a dictionary mapping camera name to device path
     cameras = {}
-    lines = output.strip().split('\n')
-    lines = [line.replace('\t', '') for line in lines]  # Remove tabs in output
-    lines = [line for line in lines if line != '']      # Remove empty lines
-    curr_line = 0
-    while curr_line < len(lines):
-
-        # Read the camera name
-        camera_name = lines[curr_line].split(":")[0]
-        curr_line += 1
-
-        # Read the camera file path
-        camera_path = lines[curr_line]
-        curr_line += 1
-
-        # Add camera to dictionary
-        cameras[camera_name] = camera_path
-
-        # Skip over other device file paths
-        while curr_line < len(lines) and lines[curr_line].startswith('/dev/'):
-            curr_line += 1
+    for device in devices:
+        try:
+            name = (device / "name").read_text().strip()
+        except OSError as e:
+            print(f"{e}")
+            continue
+
+        # Only use the name up to the first colon (e.g. "HD USB Camera: HD USB Camera")
+        cameras.setdefault(name.split(":")[0], str(DEVICE_PATH / device.name))
     return cameras
 
 
+class Resolution(NamedTuple):
+    """
+    The resolution of a frame in pixels
+    """
+    horizontal: int
+    vertical: int
+
+    def __str__(self) -> str:
+        return f"{self.horizontal}x{self.vertical}"
+
+
 class Camera:
     """
     A representation of camera that stores information like name, camera index, etc.
     """
 
-    def __init__(self, camera_name: str, camera_path: str, camera_fps: int = 30):
+    def __init__(self, camera_name: str, camera_path: str, camera_fps: int = 30,
+                 on_change: Callable[[], None] | None = None):
         self.name: str = camera_name
         self.path: str = camera_path
         self.fps: int = camera_fps
+        self.frame_interval_ns: int = fps_to_ns(camera_fps)
         self.is_running: bool = False
 
         """
@@ -65,11 +86,140 @@ class Camera:
         """
         self.encoding_params: list[int] = [cv2.IMWRITE_JPEG_QUALITY, 90]
 
+        # Resolution frames are scaled to before being sent, None sends them at the camera's resolution.
+        # Encoding time and frame size both grow with the number of pixels, so this lowers bandwidth.
+        self.stream_resolution: Resolution | None = None
+
+        # Process capturing and encoding frames (and what it shares with this process) while streaming
+        self.worker: CameraWorker | None = None
+        self.frame_shm: SharedMemory | None = None
+
+        # Called whenever the camera is started, stopped or has its settings changed
+        self.on_change: Callable[[], None] | None = on_change
+
+    def __changed(self):
+        """
+        Let whoever is watching the camera know that it changed
+        """
+        if self.on_change is not None:
+            self.on_change()
+
+    def set_fps(self, fps: int):
+        """
+        Change the fps of the camera, updating the worker if the camera is streaming
+        """
+        self.fps = fps
+        self.frame_interval_ns = fps_to_ns(fps)
+        if self.worker is not None:
+            self.worker.config_queue.put(('frame_interval_ns', self.frame_interval_ns))
+        self.__changed()
+
+    def set_encoding_quality(self, encoding_quality: int):
+        """
+        Change the JPEG quality (0-100) of the camera, updating the worker if the camera is streaming
+        """
+        self.encoding_params = [cv2.IMWRITE_JPEG_QUALITY, encoding_quality]
+        if self.worker is not None:
+            self.worker.config_queue.put(('quality', encoding_quality))
+        self.__changed()
+
+    def set_stream_resolution(self, resolution: Resolution | None):
+        """
+        Change the resolution frames are sent at, updating the worker if the camera is streaming
+        """
+        self.stream_resolution = resolution
+        if self.worker is not None:
+            self.worker.config_queue.put(('stream_size', self.__stream_size()))
+        self.__changed()
+
+    def __stream_size(self) -> tuple[int, int] | None:
+        """
+        Return the stream resolution as the plain (width, height) tuple that OpenCV expects
+        """
+        if self.stream_resolution is None:
+            return None
+        return tuple(self.stream_resolution)
+
+    def start(self):
+        """
+        Start a worker process that captures and encodes frames from the camera
+        """
+        self.frame_shm = SharedMemory(create=True, size=FRAME_SLOTS * MAX_JPEG_SIZE)
+        self.worker = CameraWorker(self.path, self.frame_interval_ns, self.encoding_params[1], self.__stream_size(),
+                                   self.frame_shm.name,
+                                   frame_sizes=mp_context.Array('I', FRAME_SLOTS, lock=False),
+                                   write_sem=mp_context.Semaphore(FRAME_SLOTS),
+                                   read_sem=mp_context.Semaphore(0),
+                                   config_queue=mp_context.Queue(),
+                                   stop_event=mp_context.Event())
+        self.worker.start()
+        self.is_running = True
+        self.__changed()
+
+    def stop(self):
+        """
+        Stop streaming the camera. The worker is cleaned up once `stream_async` sees the camera stopped.
+        """
+        self.is_running = False
+        if self.worker is not None:
+            self.worker.stop_event.set()
+        self.__changed()
+
+    async def stream_async(self):
+        """
+        An async generator that will yield JPEG frames from the worker until the camera is stopped
+
+        Frames are memoryviews of the worker's shared memory, so they aren't copied, and each one is only valid
+        until the next frame is asked for (the worker is then allowed to reuse its slot).
+        Waiting for frames happens on `frame_wait_pool` so the event loop can handle other requests in the meantime.
+        The worker and shared memory are kept in locals since the camera may be restarted before they're released.
+        """
+        worker = self.worker
+        frame_shm = self.frame_shm
+        slot = 0
+        pending_read = None
+        try:
+            while not worker.stop_event.is_set() and worker.is_alive():
+                # Wait for the next frame, giving up after a bit so the stream can check if it was ended
+                pending_read = frame_wait_pool.submit(worker.read_sem.acquire, timeout=0.1)
+                if not await asyncio.wrap_future(pending_read):
+                    continue
+
+                # Send the frame straight out of its slot, then hand the slot back to the worker
+                start = slot * MAX_JPEG_SIZE
+                with frame_shm.buf[start:start + worker.frame_sizes[slot]] as frame:
+                    yield frame
+                worker.write_sem.release()
+                slot = (slot + 1) % FRAME_SLOTS
+        finally:
+            worker.stop_event.set()
+            if self.worker is worker:
+                self.is_running = False
+                self.worker = None
+                self.frame_shm = None
+                self.__changed()
+
+            # Release on the pool, since joining the worker blocks
+            frame_wait_pool.submit(self.__release, worker, frame_shm, pending_read)
+
+    def __release(self, worker: CameraWorker, frame_shm: SharedMemory, pending_read: Future | None):
+        """
+        Stop the worker process and free the shared memory once the last wait for a frame is done
+        """
+        if pending_read is not None:
+            wait([pending_read])
+
+        worker.join(timeout=1)
+        if worker.is_alive():
+            worker.terminate()
+
+        frame_shm.close()
+        frame_shm.unlink()
+
 
 class CameraNotFoundError(Exception):
     def __init__(self, camera_name: str):
-        self.message = f"Error: Camera with name {
-            camera_name} cannot be found."
+        self.message = f"Error: Camera with name {camera_name} cannot be found."
         super().__init__(self.message)
 
 
@@ -80,19 +230,58 @@ class CameraManger:
     """
 
     def __init__(self):
-        # List of available cameras
-        self.cameras: list[Camera] = self.__create_cameras()
-
-    def __create_cameras(self) -> list[Camera]:
+        # Version of the cameras' state, which changes whenever a camera is added, removed, started, stopped
+        # or has its settings changed (so clients can tell if anything changed since they last asked)
+        self.__versions = itertools.count()
+        self.state_version: int = next(self.__versions)
+
+        # List of available cameras, along with the same cameras keyed by name so they can be looked up
+        # without searching the list
+        self.cameras: list[Camera] = []
+        self.__cameras_by_name: dict[str, Camera] = {}
+        self.__update_cameras()
+
+        # Update the cameras whenever one is plugged in or unplugged
+        if INotify is not None:
+            threading.Thread(target=self.__watch_cameras, daemon=True).start()
+
+    def __update_cameras(self):
         """
-        Create a list of cameras available on the computer
+        Update the list of cameras available on the computer, keeping the Camera objects
+        (and their settings) of cameras that are still connected
         NOTE: Will only work on Linux
         """
         camera_dict = get_camera_name_and_paths()
         cameras = []
         for camera_name, camera_path in camera_dict.items():
-            cameras.append(Camera(camera_name, camera_path))
-        return cameras
+            camera = self.__cameras_by_name.get(camera_name)
+            if camera is None or camera.path != camera_path:
+                camera = Camera(camera_name, camera_path, on_change=self.__state_changed)
+            cameras.append(camera)
+
+        self.cameras = cameras
+        self.__cameras_by_name = {camera.name: camera for camera in cameras}
+        self.__state_changed()
+
+    def __state_changed(self):
+        """
+        Move to a new state version (called whenever a camera changes)
+        """
+        # Taking the next value of a counter is atomic, so changes from other threads are never lost
+        self.state_version = next(self.__versions)
+
+    def __watch_cameras(self):
+        """
+        Wait for video device files to be created or removed and update the cameras when they are
+        (run on its own thread)
+        """
+        inotify = INotify()
+        inotify.add_watch(DEVICE_PATH, flags.CREATE | flags.DELETE)
+        while True:
+            # Wait a bit after the first event, since a camera creates several device files at once
+            events = inotify.read(read_delay=100)
+            if any(event.name.startswith("video") for event in events):
+                self.__update_cameras()
 
     def __get_camera(self, camera_name: str) -> Camera:
         """
@@ -100,12 +289,10 @@ class CameraManger:
 
         Raises: CameraNotFoundError if specified camera cannot be found
         """
-        for camera in self.cameras:
-            if camera.name == camera_name:
-                return camera
-
-        # Raise error if camera not found
-        raise CameraNotFoundError(camera_name)
+        try:
+            return self.__cameras_by_name[camera_name]
+        except KeyError:
+            raise CameraNotFoundError(camera_name)
 
     def get_camera_fps(self, camera_name: str) -> int:
         """
@@ -129,7 +316,7 @@ class CameraManger:
             camera = self.__get_camera(camera_name)
         except CameraNotFoundError:
             raise
-        camera.fps = fps
+        camera.set_fps(fps)
 
     def get_camera_encoding_params(self, camera_name: str) -> list[int]:
         """
@@ -156,7 +343,31 @@ class CameraManger:
             raise
 
         # Change quality of captured frames
-        camera.encoding_params[1] = encoding_quality
+        camera.set_encoding_quality(encoding_quality)
+
+    def get_camera_stream_resolution(self, camera_name: str) -> Resolution | None:
+        """
+        Return the resolution frames are sent at given a camera name, None if they're sent at the camera's resolution
+
+        Raises: CameraNotFoundError if specified camera cannot be found
+        """
+        try:
+            camera = self.__get_camera(camera_name)
+        except CameraNotFoundError:
+            raise
+        return camera.stream_resolution
+
+    def set_camera_stream_resolution(self, camera_name: str, resolution: Resolution | None):
+        """
+        Set the resolution frames are sent at given a camera name, None to send them at the camera's resolution
+
+        Raises: CameraNotFoundError if specified camera cannot be found
+        """
+        try:
+            camera = self.__get_camera(camera_name)
+        except CameraNotFoundError:
+            raise
+        camera.set_stream_resolution(resolution)
 
     def camera_is_running(self, camera_name: str) -> bool:
         """
@@ -170,9 +381,9 @@ class CameraManger:
             raise
         return camera.is_running
 
-    def start_video_capture(self, camera_name: str) -> cv2.VideoCapture:
+    def start_video_capture(self, camera_name: str) -> Camera:
         """
-        Given a camera name, return an openCV video capture object (to read frames)
+        Given a camera name, start capturing frames on a worker process and return the camera (to stream frames)
 
         Raises: CameraNotFoundError if specified camera cannot be found
 
@@ -182,10 +393,9 @@ class CameraManger:
         except CameraNotFoundError:
             raise
 
-        # Create video capture device
-        cap = cv2.VideoCapture(camera.path)
-        camera.is_running = True
-        return cap
+        # Start capturing from the camera
+        camera.start()
+        return camera
 
     def end_video_capture(self, camera_name: str):
         """
@@ -197,14 +407,10 @@ class CameraManger:
             camera = self.__get_camera(camera_name)
         except CameraNotFoundError:
             raise
-        camera.is_running = False
+        camera.stop()
 
     def get_available_cameras(self) -> list[str]:
         """
         Return a list of cameras which are not currently being used
         """
-        available_cameras = []
-        for camera in self.cameras:
-            if not camera.is_running:
-                available_cameras.append(camera.name)
-        return available_cameras
+        return [camera.name for camera in self.cameras if not camera.is_running]
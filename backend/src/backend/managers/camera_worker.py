@@ -0,0 +1,300 @@
+import multiprocessing
+from multiprocessing.context import SpawnProcess
+from multiprocessing.shared_memory import SharedMemory
+import queue
+import threading
+import time
+import cv2
+
+from backend.encoding import can_encode_yuyv, encode_jpeg_into, encode_yuyv_into, max_jpeg_size
+
+# Workers are spawned rather than forked since forking the multi-threaded api process
+# (uvicorn, OpenCV thread pools, etc.) can deadlock the child
+mp_context = multiprocessing.get_context("spawn")
+
+# Number of encoded frames that can be waiting in shared memory for each camera
+FRAME_SLOTS = 3
+
+# Largest resolution frames can be sent at
+MAX_FRAME_WIDTH = 1920
+MAX_FRAME_HEIGHT = 1080
+
+# Size of each frame slot in shared memory.
+# This is the largest a JPEG of the largest frame could possibly be, so TurboJPEG can always encode in place
+MAX_JPEG_SIZE = max_jpeg_size(MAX_FRAME_WIDTH, MAX_FRAME_HEIGHT)
+
+# Cameras that support MJPEG send frames that are already JPEGs, so they are sent without re-encoding.
+# The quality of those frames can't be changed, so they're treated as our default quality (90)
+# and frames are only re-encoded if a lower quality is asked for.
+MJPG_FOURCC = cv2.VideoWriter_fourcc(*'MJPG')
+NATIVE_MJPEG_QUALITY = 90
+
+# Cameras that can't send MJPEG usually send YUYV, which TurboJPEG can encode straight from its Y, U and V planes
+# instead of OpenCV converting it to BGR and the encoder converting it back again
+YUYV_FOURCC = cv2.VideoWriter_fourcc(*'YUYV')
+
+# Formats frames can be captured in: already encoded JPEGs, raw YUYV or BGR (converted by OpenCV)
+JPEG_FORMAT = 'jpeg'
+YUYV_FORMAT = 'yuyv'
+BGR_FORMAT = 'bgr'
+
+
+class CameraWorker(SpawnProcess):
+    """
+    A process that captures and encodes the frames for a single camera.
+
+    Encoded frames are written into a ring of `FRAME_SLOTS` slots in shared memory (each `MAX_JPEG_SIZE` bytes)
+    and the size of each frame is written to `frame_sizes`. `write_sem` counts the free slots
+    and `read_sem` counts the slots with a frame that is ready to be read.
+    Changes to the frame interval, quality or stream size are sent through `config_queue` as `(setting, value)` pairs.
+    """
+
+    def __init__(self, camera_path: str, frame_interval_ns: int, quality: int, stream_size: tuple[int, int] | None,
+                 frame_shm_name: str, frame_sizes, write_sem, read_sem, config_queue, stop_event):
+        super().__init__(daemon=True)
+        self.camera_path: str = camera_path
+        self.frame_interval_ns: int = frame_interval_ns
+        self.quality: int = quality
+        self.encoding_params: list[int] = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+        # (width, height) frames are resized to before being encoded, None to send them at the camera's resolution
+        self.stream_size: tuple[int, int] | None = stream_size
+        self.frame_shm_name: str = frame_shm_name
+        self.frame_sizes = frame_sizes
+        self.write_sem = write_sem
+        self.read_sem = read_sem
+        self.config_queue = config_queue
+        self.stop_event = stop_event
+
+    def __apply_config_changes(self) -> bool:
+        """
+        Apply any frame interval, quality or stream size changes that were sent by the camera
+
+        Returns True if any settings were changed
+        """
+        changed = False
+        while True:
+            try:
+                setting, value = self.config_queue.get_nowait()
+            except queue.Empty:
+                return changed
+
+            changed = True
+            if setting == 'frame_interval_ns':
+                self.frame_interval_ns = value
+            elif setting == 'quality':
+                self.quality = value
+                self.encoding_params = [cv2.IMWRITE_JPEG_QUALITY, value]
+            elif setting == 'stream_size':
+                self.stream_size = value
+
+    def __choose_frame_format(self, is_mjpeg: bool, is_yuyv: bool) -> str:
+        """
+        Choose whether the camera's MJPEG frames are sent as-is, its YUYV frames are encoded as they are,
+        or frames are converted to BGR so they can be resized and re-encoded.
+        The capture thread switches OpenCV's RGB conversion to match before its next read.
+
+        Returns the format frames should be captured in
+        """
+        # Frames need to be converted to BGR if they're being resized or the backend can't send raw frames
+        if not self.raw_frames_supported or self.stream_size is not None:
+            frame_format = BGR_FORMAT
+        elif is_mjpeg and self.quality >= NATIVE_MJPEG_QUALITY:
+            frame_format = JPEG_FORMAT
+        elif is_yuyv:
+            frame_format = YUYV_FORMAT
+        else:
+            frame_format = BGR_FORMAT
+
+        self.frame_format = frame_format
+        return frame_format
+
+    def __capture_frames(self, cap: cv2.VideoCapture):
+        """
+        Read frames from the camera as fast as it sends them until told to stop (run on its own thread)
+
+        Frames are read into whichever of the two `captured_frames` isn't being encoded, replacing any older
+        frame that wasn't encoded in time, so encoding the previous frame overlaps with waiting on the camera.
+        The format each frame was captured in is kept in `captured_formats`.
+        """
+        frame_format = None
+        while not self.stop_event.is_set():
+            if self.frame_format != frame_format:
+                frame_format = self.frame_format
+
+                # Without RGB conversion OpenCV returns the raw frames it receives instead of converting them to BGR
+                is_raw = frame_format != BGR_FORMAT
+                if not cap.set(cv2.CAP_PROP_CONVERT_RGB, int(not is_raw)) and is_raw:
+                    # The backend can't turn RGB conversion off, so fall back to BGR frames
+                    self.raw_frames_supported = False
+                    frame_format = self.frame_format = BGR_FORMAT
+                    cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+
+            # Pick the frame that isn't being encoded
+            with self.frame_lock:
+                if self.encoding_index is not None:
+                    index = self.encoding_index ^ 1
+                elif self.newest_index is not None:
+                    index = self.newest_index ^ 1
+                else:
+                    index = 0
+                if self.newest_index == index:
+                    self.newest_index = None
+                    self.frame_ready.clear()
+
+            # Capture a video frame, reusing the old frame's memory when possible
+            success, frame = cap.read(self.captured_frames[index])
+            if not success:
+                break
+
+            with self.frame_lock:
+                self.captured_frames[index] = frame
+                self.captured_formats[index] = frame_format
+                self.newest_index = index
+                self.frame_ready.set()
+
+    def __take_newest_frame(self, timeout: float) -> tuple[cv2.Mat, str] | None:
+        """
+        Wait for a newly captured frame and keep the capture thread from overwriting it
+        until `__finish_frame` is called. Returns the frame and the format it was captured in,
+        or None if no frame was captured in time.
+        """
+        if not self.frame_ready.wait(timeout):
+            return None
+        with self.frame_lock:
+            self.encoding_index = self.newest_index
+            self.newest_index = None
+            self.frame_ready.clear()
+            return self.captured_frames[self.encoding_index], self.captured_formats[self.encoding_index]
+
+    def __finish_frame(self):
+        """
+        Let the capture thread reuse the frame that was taken
+        """
+        with self.frame_lock:
+            self.encoding_index = None
+
+    def __resize(self, frame: cv2.Mat, gpu_frame) -> cv2.Mat:
+        """
+        Resize a frame to the stream size, on the GPU if there is one (`gpu_frame` is not None)
+        """
+        if gpu_frame is not None:
+            gpu_frame.upload(frame)
+            return cv2.cuda.resize(gpu_frame, self.stream_size, interpolation=cv2.INTER_AREA).download()
+        return cv2.resize(frame, self.stream_size, interpolation=cv2.INTER_AREA)
+
+    def run(self):
+        """
+        Encode frames at the specified frame rate and write them to shared memory until told to stop
+        """
+        frame_shm = SharedMemory(name=self.frame_shm_name)
+        cap = cv2.VideoCapture(self.camera_path)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Set camera parameters.
+
+        # Ask the camera for MJPEG so frames don't need to be decoded and re-encoded
+        cap.set(cv2.CAP_PROP_FOURCC, MJPG_FOURCC)
+        is_v4l2 = cap.getBackendName() == 'V4L2'
+        is_mjpeg = is_v4l2 and int(cap.get(cv2.CAP_PROP_FOURCC)) == MJPG_FOURCC
+
+        # Otherwise ask for YUYV so frames can be encoded without converting them to BGR,
+        # falling back to BGR if the camera doesn't support it.
+        # TurboJPEG pads the rows of each plane to 4 bytes, so the width has to be a multiple of 8.
+        is_yuyv = False
+        self.raw_frames_supported = True
+        if is_v4l2 and not is_mjpeg and can_encode_yuyv():
+            cap.set(cv2.CAP_PROP_FOURCC, YUYV_FOURCC)
+            self.frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            self.frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            is_yuyv = int(cap.get(cv2.CAP_PROP_FOURCC)) == YUYV_FOURCC and self.frame_width % 8 == 0
+        self.__choose_frame_format(is_mjpeg, is_yuyv)
+
+        # Resize frames on the GPU if OpenCV was built with CUDA and one is available
+        gpu_frame = None
+        if hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0:
+            gpu_frame = cv2.cuda_GpuMat()
+
+        # Start capturing frames on their own thread
+        self.captured_frames: list[cv2.Mat | None] = [None, None]
+        self.captured_formats: list[str | None] = [None, None]
+        self.newest_index: int | None = None
+        self.encoding_index: int | None = None
+        self.frame_lock = threading.Lock()
+        self.frame_ready = threading.Event()
+        capture_thread = threading.Thread(target=self.__capture_frames, args=(cap,), daemon=True)
+        capture_thread.start()
+
+        slot = 0
+        frame_interval_ns = self.frame_interval_ns
+        next_frame_ns = time.monotonic_ns()
+        try:
+            while not self.stop_event.is_set():
+                if self.__apply_config_changes():
+                    frame_interval_ns = self.frame_interval_ns
+                    self.__choose_frame_format(is_mjpeg, is_yuyv)
+
+                # Sleep until the next frame is due (waking early if the stream is ended)
+                now_ns = time.monotonic_ns()
+                delay_ns = next_frame_ns - now_ns
+                if delay_ns > 0 and self.stop_event.wait(delay_ns / 1e9):
+                    break
+
+                # Get the newest video frame, stopping if the camera can't be read from anymore
+                newest_frame = self.__take_newest_frame(timeout=0.1)
+                if newest_frame is None:
+                    if not capture_thread.is_alive():
+                        break
+                    continue
+                frame, captured_format = newest_frame
+
+                try:
+                    # Schedule the next frame, skipping any frames we fell behind on
+                    next_frame_ns += frame_interval_ns
+                    if next_frame_ns < now_ns:
+                        next_frame_ns = now_ns + frame_interval_ns
+
+                    # Skip frames that were captured before we switched formats
+                    if captured_format != self.frame_format:
+                        continue
+
+                    # Raw frames are a single row of bytes, anything else was still converted to BGR by OpenCV
+                    if captured_format == JPEG_FORMAT and frame.shape[0] != 1:
+                        captured_format = BGR_FORMAT
+                    elif captured_format == YUYV_FORMAT and frame.ndim == 3 and frame.shape[2] == 3:
+                        captured_format = BGR_FORMAT
+
+                    # Wait for a free slot, giving up on this frame if the reader is behind
+                    if not self.write_sem.acquire(timeout=0.1):
+                        continue
+
+                    # Encode frame straight into its slot (or copy it in if it's already a JPEG)
+                    start = slot * MAX_JPEG_SIZE
+                    with frame_shm.buf[start:start + MAX_JPEG_SIZE] as slot_buffer:
+                        if captured_format == JPEG_FORMAT:
+                            size = frame.size
+                            if size <= MAX_JPEG_SIZE:
+                                slot_buffer[:size] = frame.reshape(-1)
+                            else:
+                                size = None
+                        elif captured_format == YUYV_FORMAT:
+                            size = encode_yuyv_into(frame, self.frame_width, self.frame_height, self.quality,
+                                                    slot_buffer)
+                        else:
+                            height, width = frame.shape[:2]
+                            if self.stream_size is not None and self.stream_size != (width, height):
+                                frame = self.__resize(frame, gpu_frame)
+                            size = encode_jpeg_into(frame, self.encoding_params, slot_buffer)
+                    if size is None:
+                        self.write_sem.release()
+                        continue
+                    self.frame_sizes[slot] = size
+                finally:
+                    self.__finish_frame()
+
+                # Let the reader know the frame is ready
+                self.read_sem.release()
+                slot = (slot + 1) % FRAME_SLOTS
+        finally:
+            self.stop_event.set()
+            capture_thread.join()
+            cap.release()
+            frame_shm.close()
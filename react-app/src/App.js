@@ -1,6 +1,38 @@
 import React, { useState, useEffect } from 'react';
 import './App.css';
 
+//Shows a camera's video feed. The server sends each frame as a JPEG over a WebSocket,
+//and each one is shown by pointing the image at a blob URL of the frame
+function CameraFeed({ cameraName }) {
+  const [frameUrl, setFrameUrl] = useState(null);
+
+  useEffect(() => {
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const socket = new WebSocket(`${protocol}//${window.location.host}/stream/ws/${encodeURIComponent(cameraName)}`);
+    socket.binaryType = 'blob';
+
+    //Free the previous frame's blob URL whenever a new frame is shown
+    let currentUrl = null;
+    socket.onmessage = (event) => {
+      const url = URL.createObjectURL(new Blob([event.data], { type: 'image/jpeg' }));
+      setFrameUrl(url);
+      if (currentUrl) {
+        URL.revokeObjectURL(currentUrl);
+      }
+      currentUrl = url;
+    };
+
+    return () => {
+      socket.close();
+      if (currentUrl) {
+        URL.revokeObjectURL(currentUrl);
+      }
+    };
+  }, [cameraName]);
+
+  return <img src={frameUrl} alt="Camera Frame" width="600" height="400" />;
+}
+
 //filepath for testing (DELETE LATER): ../../../GitHub/Automomous/examples/ARTrackerTest/videos
 function App() {
   const [fpsSlider, setFpsSlider] = useState(50); // Initial fps slider value
@@ -46,7 +78,7 @@ function App() {
         {selectedCamera && (
         <div>
           <div className="camera-feed">
-            <img src={`/video_feed/${selectedCamera}`} alt="Camera Frame" width="600" height="400" />
+            <CameraFeed cameraName={selectedCamera} />
           </div>
           <div className="slider-container">
             <label htmlFor="fpsSlider">FPS:</label>